@@ -5,10 +5,16 @@ import json
 import shutil
 import zlib
 import base64
+import collections.abc
+import http.client
+import threading
+import time
 import urllib.parse
 import urllib.request
 import urllib.error
 import platform
+import select
+import socket
 from datetime import datetime, timezone
 import dateutil.parser
 import ssl
@@ -17,7 +23,7 @@ import re
 import typing
 import warnings
 
-from .common import ClientError, LoginError, InvalidProject, ErrorCode
+from .common import ClientError, LoginError, InvalidProject, ErrorCode, UPLOAD_CHUNK_SIZE
 from .merginproject import MerginProject
 from .client_pull import (
     download_file_finalize,
@@ -49,6 +55,105 @@ class ServerType(Enum):
     SAAS = auto()  # Server is SaaS
 
 
+class KeepAliveHTTPSHandler(urllib.request.HTTPSHandler):
+    """
+    HTTPS handler that keeps connections open and reuses them for further requests made from the same
+    thread, so that uploads and downloads of many chunks do not pay for a new TCP and TLS handshake
+    every time (default urllib handler closes the connection after each request).
+    """
+
+    # connections idle for longer than this (in seconds) are not reused - they may have been dropped
+    # silently by a NAT or proxy, and requests that are not idempotent can't be re-sent after a failure
+    max_idle_time = 60
+
+    def __init__(self, context=None):
+        super().__init__(context=context)
+        self._local = threading.local()
+
+    def https_open(self, req):
+        return self.do_open(http.client.HTTPSConnection, req, context=self._context)
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.host
+        if not host:
+            raise urllib.error.URLError("no host given")
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+        tunnel_headers = {}
+        if req._tunnel_host and "Proxy-Authorization" in headers:
+            # Proxy-Authorization should not be sent to origin server
+            tunnel_headers["Proxy-Authorization"] = headers.pop("Proxy-Authorization")
+
+        key = (host, req._tunnel_host)
+        connections = self._local.__dict__.setdefault("connections", {})
+        conn, last_resp, last_used = connections.pop(key, (None, None, None))
+        if conn is not None and (
+            not last_resp.isclosed() or time.monotonic() - last_used > self.max_idle_time or self._is_dropped(conn)
+        ):
+            # previous response has not been read completely, the connection has been idle for too long
+            # or the server has closed it - the connection can't be used anymore
+            conn.close()
+            conn = None
+        reused = conn is not None
+
+        while True:
+            if conn is None:
+                conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                conn.set_debuglevel(self._debuglevel)
+                if req._tunnel_host:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            request_sent = False
+            try:
+                try:
+                    conn.request(
+                        req.get_method(),
+                        req.selector,
+                        req.data,
+                        headers,
+                        encode_chunked=req.has_header("Transfer-encoding"),
+                    )
+                    request_sent = True
+                except OSError as err:
+                    raise urllib.error.URLError(err)
+                resp = conn.getresponse()
+            except Exception as err:
+                conn.close()
+                reason = err.reason if isinstance(err, urllib.error.URLError) else err
+                # once the request is sent, the server may have processed it already - only idempotent
+                # requests can be sent again then (e.g. a second push start would leave a dangling transaction)
+                can_resend = not isinstance(req.data, collections.abc.Iterator) and (
+                    not request_sent or req.get_method() in ("GET", "HEAD")
+                )
+                if reused and can_resend and isinstance(reason, OSError) and not isinstance(reason, socket.timeout):
+                    # server has probably closed the idle connection in the meantime - try again with a new one
+                    conn, reused = None, False
+                    continue
+                raise
+            break
+
+        connections[key] = (conn, resp, time.monotonic())
+        resp.url = req.get_full_url()
+        resp.msg = resp.reason
+        return resp
+
+    @staticmethod
+    def _is_dropped(conn):
+        """Returns whether the idle connection got closed by the server (it is readable without a pending request)"""
+        if conn.sock is None:
+            return True
+        try:
+            if hasattr(select, "poll"):
+                # unlike select(), poll() works with descriptors above FD_SETSIZE (processes with many open files)
+                poller = select.poll()
+                poller.register(conn.sock, select.POLLIN)
+                return bool(poller.poll(0))
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+
 def decode_token_data(token):
     token_prefix = "Bearer ."
     if not token.startswith(token_prefix):
@@ -84,6 +189,7 @@ class MerginClient:
         self._user_info = None
         self._server_type = None
         self._server_version = None
+        self.upload_chunk_size = UPLOAD_CHUNK_SIZE  # adjusted after each push according to upload speed
         self.client_version = "Python-client/" + __version__
         if plugin_version is not None:  # this could be e.g. "Plugin/2020.1 QGIS/3.14"
             self.client_version += " " + plugin_version
@@ -120,14 +226,14 @@ class MerginClient:
         # is fixed.
         default_capath = ssl.get_default_verify_paths().openssl_capath
         if os.path.exists(default_capath):
-            self.opener = urllib.request.build_opener(*handlers, urllib.request.HTTPSHandler())
+            self.opener = urllib.request.build_opener(*handlers, KeepAliveHTTPSHandler())
         else:
             cafile = os.path.join(this_dir, "cert.pem")
             if not os.path.exists(cafile):
                 raise Exception("missing " + cafile)
             ctx = ssl.SSLContext()
             ctx.load_verify_locations(cafile)
-            https_handler = urllib.request.HTTPSHandler(context=ctx)
+            https_handler = KeepAliveHTTPSHandler(context=ctx)
             self.opener = urllib.request.build_opener(*handlers, https_handler)
         urllib.request.install_opener(self.opener)
 
@@ -233,14 +339,14 @@ class MerginClient:
     def post(self, path, data=None, headers={}):
         url = urllib.parse.urljoin(self.url, urllib.parse.quote(path))
         if headers.get("Content-Type", None) == "application/json":
-            data = json.dumps(data, cls=DateTimeEncoder).encode("utf-8")
+            data = json.dumps(data, cls=DateTimeEncoder, separators=(",", ":")).encode("utf-8")
         request = urllib.request.Request(url, data, headers, method="POST")
         return self._do_request(request)
 
     def patch(self, path, data=None, headers={}):
         url = urllib.parse.urljoin(self.url, urllib.parse.quote(path))
         if headers.get("Content-Type", None) == "application/json":
-            data = json.dumps(data, cls=DateTimeEncoder).encode("utf-8")
+            data = json.dumps(data, cls=DateTimeEncoder, separators=(",", ":")).encode("utf-8")
         request = urllib.request.Request(url, data, headers, method="PATCH")
         return self._do_request(request)
 
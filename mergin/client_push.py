@@ -11,16 +11,58 @@ To finish the upload job, we have to call push_project_finalize(job).
 
 import json
 import hashlib
+import logging
 import pprint
 import tempfile
 import concurrent.futures
 import os
+import threading
+import time
 
-from .common import UPLOAD_CHUNK_SIZE, ClientError
+from .common import UPLOAD_CHUNK_SIZE, MIN_UPLOAD_CHUNK_SIZE, ClientError
 from .merginproject import MerginProject
 from .editor import filter_changes
 
 
+def _upload_workers_count():
+    """Returns number of upload workers, can be overridden by MERGIN_UPLOAD_WORKERS environment variable"""
+    # Chunk hashing runs in C with the GIL released, so uploads scale with the number of cores.
+    # Keep at least four workers, network-bound uploads benefit from them even on a single core.
+    default = min(8, max(4, os.cpu_count() or 1))
+    value = os.environ.get("MERGIN_UPLOAD_WORKERS")
+    if value is None:
+        return default
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        # this runs on import - an invalid value must not break the whole client
+        logging.getLogger("mergin.client").warning(
+            f"Invalid MERGIN_UPLOAD_WORKERS value {value!r}, using {default} upload workers"
+        )
+        return default
+    return count
+
+
+_UPLOAD_WORKERS = _upload_workers_count()
+
+# Size of blocks in which chunks are read from files and sent to server
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Expected range of upload time of a single chunk (in seconds). Chunk size used for the next push gets
+# reduced for slow connections, to keep progress reporting and cancellation (done between chunks) responsive,
+# and increased again (up to the server's limit) for fast connections to save the per-request overhead.
+UPLOAD_CHUNK_TIME_RANGE = (2.5, 10)
+
+# Per-thread data of upload workers (buffer for reading of blocks)
+_thread_data = threading.local()
+
+# Thread pool shared by all upload jobs, so that worker threads (and their open connections)
+# are not created and torn down again for every push
+_UPLOAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=_UPLOAD_WORKERS, thread_name_prefix="mergin-upload")
+
+
 class UploadJob:
     """Keeps all the important data about a pending upload job"""
 
@@ -29,13 +71,19 @@ class UploadJob:
         self.changes = changes  # dictionary of local changes to the project
         self.transaction_id = transaction_id  # ID of the transaction assigned by the server
         self.total_size = 0  # size of data to upload (in bytes)
+        self.chunk_size = UPLOAD_CHUNK_SIZE  # size of chunks (in bytes) that files are split into
+        self.chunk_upload_times = []  # how long it took to upload chunks of full size (in seconds)
         self.transferred_size = 0  # size of data already uploaded (in bytes)
+        self.pending_items = 0  # number of upload tasks that have not finished yet
+        self.upload_error = None  # first exception raised by a worker
+        self.lock = threading.Lock()  # guards updates of the above from worker threads
         self.upload_queue_items = []  # list of items to upload in the background
         self.mp = mp  # MerginProject instance
         self.mc = mc  # MerginClient instance
         self.tmp_dir = tmp_dir  # TemporaryDirectory instance for any temp file we need
         self.is_cancelled = False  # whether upload has been cancelled
-        self.executor = None  # ThreadPoolExecutor that manages background upload tasks
+        self.executor = None  # ThreadPoolExecutor that manages background upload tasks (shared by all jobs)
+        self.shared_files = []  # SharedFile instances of files with multiple chunks
         self.futures = []  # list of futures submitted to the executor
         self.server_resp = None  # server response when transaction is finished
 
@@ -49,37 +97,130 @@ class UploadJob:
 class UploadQueueItem:
     """A single chunk of data that needs to be uploaded"""
 
-    def __init__(self, file_path, size, transaction_id, chunk_id, chunk_index):
+    # there may be lots of chunks in a large push - avoid per-instance __dict__
+    __slots__ = ("file_path", "size", "chunk_id", "chunk_index", "transaction_id", "offset", "shared_file", "checksum")
+
+    def __init__(self, file_path, size, transaction_id, chunk_id, chunk_index, offset, shared_file=None, checksum=None):
         self.file_path = file_path  # full path to the file
         self.size = size  # size of the chunk in bytes
         self.chunk_id = chunk_id  # ID of the chunk within transaction
         self.chunk_index = chunk_index  # index (starting from zero) of the chunk within the file
         self.transaction_id = transaction_id  # ID of the transaction
+        self.offset = offset  # position of the chunk within the file
+        self.shared_file = shared_file  # SharedFile used by all chunks of the file (None if not shared)
+        self.checksum = checksum  # known SHA1 hex checksum of the chunk (None if it needs to be computed)
+
+    def read_blocks(self):
+        """
+        Yields content of the chunk read from the file in blocks of UPLOAD_BLOCK_SIZE bytes.
+
+        Blocks are memoryviews of a buffer which gets overwritten by the next block, so they need
+        to be consumed (hashed and sent) before the next one is requested. The buffer is allocated
+        just once per thread and reused by all chunks uploaded from that thread.
+        """
+        view = getattr(_thread_data, "buffer", None)
+        if view is None:
+            view = _thread_data.buffer = memoryview(bytearray(UPLOAD_BLOCK_SIZE))
+        if self.shared_file is not None:
+            fd = self.shared_file.open()
+            for pos in range(0, self.size, UPLOAD_BLOCK_SIZE):
+                block_size = os.preadv(fd, [view[: min(UPLOAD_BLOCK_SIZE, self.size - pos)]], self.offset + pos)
+                yield view[:block_size]
+            return
+        with open(self.file_path, "rb", buffering=0) as file_handle:
+            file_handle.seek(self.offset)
+            for pos in range(0, self.size, UPLOAD_BLOCK_SIZE):
+                block_size = file_handle.readinto(view[: min(UPLOAD_BLOCK_SIZE, self.size - pos)])
+                yield view[:block_size]
 
     def upload_blocking(self, mc, mp):
-        with open(self.file_path, "rb") as file_handle:
-            file_handle.seek(self.chunk_index * UPLOAD_CHUNK_SIZE)
-            data = file_handle.read(UPLOAD_CHUNK_SIZE)
+        data = UploadChunkStream(self)
 
-            checksum = hashlib.sha1()
-            checksum.update(data)
+        mp.log.debug(f"Uploading {self.file_path} part={self.chunk_index}")
 
-            mp.log.debug(f"Uploading {self.file_path} part={self.chunk_index}")
+        # with explicit content length the data get streamed as they are (no chunked transfer encoding)
+        headers = {"Content-Type": "application/octet-stream", "Content-Length": str(self.size)}
+        resp = mc.post(
+            "/v1/project/push/chunk/{}/{}".format(self.transaction_id, self.chunk_id),
+            data,
+            headers,
+        )
+        resp_dict = json.load(resp)
+        mp.log.debug(f"Upload finished: {self.file_path}")
+        # compare raw digests - the server returns hex, decoding it is cheaper than hex-encoding our digest
+        try:
+            server_checksum = bytes.fromhex(resp_dict["checksum"])
+        except (TypeError, ValueError):
+            server_checksum = None  # malformed checksum never matches
+        local_checksum = bytes.fromhex(self.checksum) if self.checksum else data.checksum.digest()
+        if not (resp_dict["size"] == data.size and server_checksum == local_checksum):
+            try:
+                mc.post("/v1/project/push/cancel/{}".format(self.transaction_id))
+            except ClientError:
+                pass
+            raise ClientError("Mismatch between uploaded file chunk {} and local one".format(self.chunk_id))
 
-            headers = {"Content-Type": "application/octet-stream"}
-            resp = mc.post(
-                "/v1/project/push/chunk/{}/{}".format(self.transaction_id, self.chunk_id),
-                data,
-                headers,
-            )
-            resp_dict = json.load(resp)
-            mp.log.debug(f"Upload finished: {self.file_path}")
-            if not (resp_dict["size"] == len(data) and resp_dict["checksum"] == checksum.hexdigest()):
-                try:
-                    mc.post("/v1/project/push/cancel/{}".format(self.transaction_id))
-                except ClientError:
-                    pass
-                raise ClientError("Mismatch between uploaded file chunk {} and local one".format(self.chunk_id))
+
+class UploadChunkStream:
+    """
+    Request body with content of a chunk. The content is read from the file and hashed block by block
+    while it is being sent, so only a single block is kept in memory. It can be iterated repeatedly
+    (e.g. when the request needs to be re-sent) - reading and hashing then starts from the beginning.
+    Hashing is skipped if the checksum of the chunk is already known.
+    """
+
+    def __init__(self, item):
+        self.item = item  # UploadQueueItem to be sent
+        self.size = 0  # number of bytes read so far
+        self.checksum = None  # hashlib object with checksum of data read so far (None if not computed)
+
+    def __iter__(self):
+        self.size = 0
+        self.checksum = hashlib.sha1() if self.item.checksum is None else None
+        for block in self.item.read_blocks():
+            if self.checksum is not None:
+                self.checksum.update(block)
+            self.size += len(block)
+            yield block
+        if self.size != self.item.size:
+            # we have promised the server different amount of data in Content-Length header
+            raise ClientError(f"File {self.item.file_path} has changed during upload")
+
+
+class SharedFile:
+    """
+    File descriptor shared by all chunks of a file, chunks read from it with os.preadv(). The file gets opened
+    when the first chunk is read and closed once all chunks are done, so that a push of many files does not
+    keep all of them open at the same time.
+    """
+
+    def __init__(self, path, chunks_count):
+        self.path = path  # full path to the file
+        self.pending_chunks = chunks_count  # number of chunks that have not been uploaded yet
+        self.fd = None  # file descriptor (None if the file is not open)
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Returns file descriptor, opens the file if needed"""
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY)
+                if hasattr(os, "posix_fadvise"):
+                    # chunks are read more or less in order - let the kernel read ahead
+                    os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            return self.fd
+
+    def release(self):
+        """To be called when a chunk is done - closes the file after the last chunk"""
+        with self.lock:
+            self.pending_chunks -= 1
+            if self.pending_chunks == 0:
+                self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
 
 def push_project_async(mc, directory):
@@ -120,7 +261,8 @@ def push_project_async(mc, directory):
             + f"\n\nLocal version: {local_version}\nServer version: {server_version}"
         )
 
-    changes = mp.get_push_changes()
+    chunk_size = mc.upload_chunk_size
+    changes = mp.get_push_changes(chunk_size)
     changes = filter_changes(mc, project_info, changes)
     mp.log.debug("push changes:\n" + pprint.pformat(changes))
 
@@ -133,11 +275,11 @@ def push_project_async(mc, directory):
     # uploaded. The temporary copy using geodiff uses sqlite backup API and should copy everything.
     for f in changes["updated"]:
         if mp.is_versioned_file(f["path"]) and "diff" not in f:
-            mp.copy_versioned_file_for_upload(f, tmp_dir.name)
+            mp.copy_versioned_file_for_upload(f, tmp_dir.name, chunk_size)
 
     for f in changes["added"]:
         if mp.is_versioned_file(f["path"]):
-            mp.copy_versioned_file_for_upload(f, tmp_dir.name)
+            mp.copy_versioned_file_for_upload(f, tmp_dir.name, chunk_size)
 
     if not sum(len(v) for v in changes.values()):
         mp.log.info(f"--- push {project_path} - nothing to do")
@@ -164,6 +306,7 @@ def push_project_async(mc, directory):
 
     transaction_id = server_resp["transaction"] if upload_files else None
     job = UploadJob(project_path, changes, transaction_id, mp, mc, tmp_dir)
+    job.chunk_size = chunk_size
 
     if not upload_files:
         mp.log.info("not uploading any files")
@@ -181,18 +324,36 @@ def push_project_async(mc, directory):
             # versioned file - uploading diff
             file_location = mp.fpath_meta(file["diff"]["path"])
             file_size = file["diff"]["size"]
+            file_checksum = file["diff"]["checksum"]
         elif "upload_file" in file:
             # versioned file - uploading full (a temporary copy)
             file_location = file["upload_file"]
             file_size = file["size"]
+            file_checksum = file["checksum"]
         else:
             # non-versioned file
             file_location = mp.fpath(file["path"])
             file_size = file["size"]
+            file_checksum = file["checksum"]
+
+        # chunks of larger files share one file descriptor (if supported), small files are just opened by their chunk
+        shared_file = None
+        if len(file["chunks"]) > 1 and hasattr(os, "preadv"):
+            shared_file = SharedFile(file_location, len(file["chunks"]))
+            job.shared_files.append(shared_file)
+
+        # a single chunk is the whole file - its checksum is already known, no need to hash it again while uploading
+        chunk_checksum = file_checksum if len(file["chunks"]) == 1 else None
 
+        # all chunks have full size except for the last one
+        full_chunks, tail_size = divmod(file_size, chunk_size)
         for chunk_index, chunk_id in enumerate(file["chunks"]):
-            size = min(UPLOAD_CHUNK_SIZE, file_size - chunk_index * UPLOAD_CHUNK_SIZE)
-            upload_queue_items.append(UploadQueueItem(file_location, size, transaction_id, chunk_id, chunk_index))
+            size = chunk_size if chunk_index < full_chunks else tail_size
+            offset = chunk_index * chunk_size
+            item = UploadQueueItem(
+                file_location, size, transaction_id, chunk_id, chunk_index, offset, shared_file, chunk_checksum
+            )
+            upload_queue_items.append(item)
 
         total_size += file_size
 
@@ -202,7 +363,8 @@ def push_project_async(mc, directory):
     mp.log.info(f"will upload {len(upload_queue_items)} items with total size {total_size}")
 
     # start uploads in background
-    job.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    job.executor = _UPLOAD_POOL
+    job.pending_items = len(upload_queue_items)
     for item in upload_queue_items:
         future = job.executor.submit(_do_upload, item, job)
         job.futures.append(future)
@@ -211,9 +373,24 @@ def push_project_async(mc, directory):
 
 
 def push_project_wait(job):
-    """blocks until all upload tasks are finished"""
+    """
+    Blocks until all upload tasks are finished.
 
-    concurrent.futures.wait(job.futures)
+    If any of the upload tasks fails, the remaining ones are cancelled and the exception is re-raised
+    as soon as the tasks that are already running are done (without uploading the rest of the chunks).
+    """
+
+    for future in concurrent.futures.as_completed(job.futures):
+        if future.cancelled():
+            continue  # e.g. push_project_cancel() called from another thread
+        if future.exception() is not None:
+            job.mp.log.error("Error while pushing data: " + str(future.exception()))
+            job.mp.log.info("--- push aborted")
+            job.is_cancelled = True
+            _cancel_futures(job)
+            concurrent.futures.wait(job.futures)
+            _close_files(job)
+            raise future.exception()
 
 
 def push_project_is_running(job):
@@ -223,14 +400,11 @@ def push_project_is_running(job):
     It also forwards any exceptions from workers (e.g. some network errors). If an exception
     is raised, it is advised to call push_project_cancel() to abort the job.
     """
-    for future in job.futures:
-        if future.done() and future.exception() is not None:
-            job.mp.log.error("Error while pushing data: " + str(future.exception()))
-            job.mp.log.info("--- push aborted")
-            raise future.exception()
-        if future.running():
-            return True
-    return False
+    if job.upload_error is not None:
+        job.mp.log.error("Error while pushing data: " + str(job.upload_error))
+        job.mp.log.info("--- push aborted")
+        raise job.upload_error
+    return job.pending_items > 0
 
 
 def push_project_finalize(job):
@@ -246,7 +420,8 @@ def push_project_finalize(job):
     with_upload_of_files = job.executor is not None
 
     if with_upload_of_files:
-        job.executor.shutdown(wait=True)
+        concurrent.futures.wait(job.futures)
+        _close_files(job)
 
         # make sure any exceptions from threads are not lost
         for future in job.futures:
@@ -294,6 +469,8 @@ def push_project_finalize(job):
 
     remove_diff_files(job)
 
+    _update_chunk_size(job)
+
     job.mp.log.info("--- push finished - new project version " + job.server_resp["version"])
 
 
@@ -307,7 +484,10 @@ def push_project_cancel(job):
     # set job as cancelled
     job.is_cancelled = True
 
-    job.executor.shutdown(wait=True)
+    # drop uploads that have not started yet, wait for the running ones to finish
+    _cancel_futures(job)
+    concurrent.futures.wait(job.futures)
+    _close_files(job)
     try:
         resp_cancel = job.mc.post("/v1/project/push/cancel/%s" % job.transaction_id)
         job.server_resp = resp_cancel.msg
@@ -319,11 +499,57 @@ def push_project_cancel(job):
 
 def _do_upload(item, job):
     """runs in worker thread"""
-    if job.is_cancelled:
-        return
+    try:
+        if job.is_cancelled:
+            return
+
+        start_time = time.monotonic()
+        item.upload_blocking(job.mc, job.mp)
+        upload_time = time.monotonic() - start_time
+        with job.lock:
+            job.transferred_size += item.size
+            if item.size == job.chunk_size:
+                job.chunk_upload_times.append(upload_time)
+    except Exception as e:
+        with job.lock:
+            if job.upload_error is None:
+                job.upload_error = e
+        raise
+    finally:
+        if item.shared_file is not None:
+            item.shared_file.release()
+        with job.lock:
+            job.pending_items -= 1
 
-    item.upload_blocking(job.mc, job.mp)
-    job.transferred_size += item.size
+
+def _cancel_futures(job):
+    """Cancels upload tasks that have not started yet. They never run _do_upload(), so they are not pending anymore."""
+    with job.lock:
+        for future in job.futures:
+            # cancel() returns true also for futures cancelled before - do not count them again
+            if not future.cancelled() and future.cancel():
+                job.pending_items -= 1
+
+
+def _close_files(job):
+    """Closes files left open (e.g. when the upload got cancelled). To be called once no workers are running."""
+    for shared_file in job.shared_files:
+        shared_file.close()
+
+
+def _update_chunk_size(job):
+    """Adjusts chunk size to be used for the next push to the server, based on upload times of chunks"""
+    if not job.chunk_upload_times:
+        return  # no full-size chunks, nothing to judge from
+    avg_time = sum(job.chunk_upload_times) / len(job.chunk_upload_times)
+    chunk_size = job.chunk_size
+    if avg_time > UPLOAD_CHUNK_TIME_RANGE[1]:
+        chunk_size = max(MIN_UPLOAD_CHUNK_SIZE, chunk_size // 2)
+    elif avg_time < UPLOAD_CHUNK_TIME_RANGE[0]:
+        chunk_size = min(UPLOAD_CHUNK_SIZE, chunk_size * 2)
+    if chunk_size != job.mc.upload_chunk_size:
+        job.mp.log.info(f"chunk upload time {avg_time:.1f}s - changing chunk size to {chunk_size} bytes")
+        job.mc.upload_chunk_size = chunk_size
 
 
 def remove_diff_files(job) -> None:
@@ -6,6 +6,9 @@ CHUNK_SIZE = 100 * 1024 * 1024
 # there is an upper limit for chunk size on server, ideally should be requested from there once implemented
 UPLOAD_CHUNK_SIZE = 10 * 1024 * 1024
 
+# lower limit for chunk size when it gets reduced for slow connections
+MIN_UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 this_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -1,11 +1,12 @@
+import concurrent.futures
 import json
 import logging
-import math
 import os
 import re
 import shutil
 import uuid
 import tempfile
+import time
 from datetime import datetime
 from dateutil.tz import tzlocal
 
@@ -22,9 +23,16 @@ from .utils import (
     edit_conflict_file_name,
 )
 
-
 this_dir = os.path.dirname(os.path.realpath(__file__))
 
+# minimal age of file modification (in nanoseconds) for the file's checksum to be cached
+CHECKSUM_CACHE_MIN_AGE_NS = 2 * 10**9
+
+
+def new_chunk_ids(size, chunk_size):
+    """Returns new unique IDs for the upload chunks of a file with given size (integer ceil division, no floats)"""
+    return [str(uuid.uuid4()) for _ in range((size + chunk_size - 1) // chunk_size)]
+
 
 # Try to import pygeodiff from "deps" sub-directory (which should be present e.g. when
 # used within QGIS plugin), if that's not available then try to import it from standard
@@ -59,6 +67,8 @@ class MerginProject:
 
         # metadata from JSON are lazy loaded
         self._metadata = None
+        # checksums of project files from JSON are lazy loaded (see inspect_files)
+        self._checksum_cache = None
         self.is_old_metadata = False
 
         self.setup_logging(directory)
@@ -291,9 +301,18 @@ class MerginProject:
         """
         Inspect files in project directory and return metadata.
 
+        Checksums of files are cached in .mergin/.cache/checksum_cache.json along with their modification time
+        and size, so that files which have not been modified since the last inspection are not read again.
+
         :returns: metadata for files in project directory in server required format
         :rtype: list[dict]
         """
+        if self._checksum_cache is None:
+            self._checksum_cache = self._read_checksum_cache()
+        checksum_cache = {}
+        # files modified just now may get modified again without a change of mtime - do not cache them
+        cache_threshold = time.time_ns() - CHECKSUM_CACHE_MIN_AGE_NS
+
         files_meta = []
         for root, dirs, files in os.walk(self.dir, topdown=True):
             dirs[:] = [d for d in dirs if d not in [".mergin"]]
@@ -304,16 +323,52 @@ class MerginProject:
                 abs_path = os.path.abspath(os.path.join(root, file))
                 rel_path = os.path.relpath(abs_path, start=self.dir)
                 proj_path = "/".join(rel_path.split(os.path.sep))  # we need posix path
+                stat = os.stat(abs_path)
+                cached = self._checksum_cache.get(proj_path)
+                if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                    checksum = cached[2]
+                else:
+                    checksum = generate_checksum(abs_path)
+                if stat.st_mtime_ns < cache_threshold:
+                    checksum_cache[proj_path] = [stat.st_mtime_ns, stat.st_size, checksum]
                 files_meta.append(
                     {
                         "path": proj_path,
-                        "checksum": generate_checksum(abs_path),
-                        "size": os.path.getsize(abs_path),
-                        "mtime": datetime.fromtimestamp(os.path.getmtime(abs_path), tzlocal()),
+                        "checksum": checksum,
+                        "size": stat.st_size,
+                        "mtime": datetime.fromtimestamp(stat.st_mtime, tzlocal()),
                     }
                 )
+
+        if checksum_cache != self._checksum_cache:
+            self._write_checksum_cache(checksum_cache)
+        self._checksum_cache = checksum_cache
         return files_meta
 
+    def _read_checksum_cache(self) -> dict:
+        """Loads cached checksums of project files (path -> [mtime_ns, size, checksum])"""
+        try:
+            with open(self.fpath_cache("checksum_cache.json"), "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_checksum_cache(self, checksum_cache: dict) -> None:
+        """
+        Writes cached checksums of project files. The cache gets written to a temporary file first and then
+        replaced, so that other processes (or an interrupted write) never leave it incomplete.
+        """
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.cache_dir, suffix=".tmp", delete=False) as file:
+                tmp_path = file.name
+                json.dump(checksum_cache, file)
+            os.replace(tmp_path, self.fpath_cache("checksum_cache.json"))
+        except OSError as e:
+            self.log.warning("failed to write checksum cache: " + str(e))
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
     def compare_file_sets(self, origin, current):
         """
         Helper function to calculate difference between two sets of files metadata using file names and checksums.
@@ -405,7 +460,7 @@ class MerginProject:
         changes["updated"] = [f for f in changes["updated"] if f not in not_updated]
         return changes
 
-    def get_push_changes(self):
+    def get_push_changes(self, chunk_size=UPLOAD_CHUNK_SIZE):
         """
         Calculate changes needed to be pushed to server.
 
@@ -415,17 +470,26 @@ class MerginProject:
 
         .. seealso:: self.compare_file_sets
 
+        :param chunk_size: size of chunks (in bytes) in which files will be uploaded
+        :type chunk_size: int
         :returns: changes metadata for files to be pushed to server
         :rtype: dict
         """
         changes = self.compare_file_sets(self.files(), self.inspect_files())
-        # do checkpoint to push changes from wal file to gpkg
-        for file in changes["added"] + changes["updated"]:
-            size, checksum = do_sqlite_checkpoint(self.fpath(file["path"]), self.log)
-            if size and checksum:
-                file["size"] = size
-                file["checksum"] = checksum
-            file["chunks"] = [str(uuid.uuid4()) for i in range(math.ceil(file["size"] / UPLOAD_CHUNK_SIZE))]
+        # do checkpoint to push changes from wal file to gpkg (files are independent, so do it in parallel)
+        upload_files = changes["added"] + changes["updated"]
+        wal_files = [f for f in upload_files if ".gpkg" in f["path"] and os.path.exists(self.fpath(f["path"]) + "-wal")]
+        if wal_files:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(4, os.cpu_count() or 1, len(wal_files))
+            ) as executor:
+                checkpoints = executor.map(lambda f: do_sqlite_checkpoint(self.fpath(f["path"]), self.log), wal_files)
+                for file, (size, checksum) in zip(wal_files, list(checkpoints)):
+                    if size and checksum:
+                        file["size"] = size
+                        file["checksum"] = checksum
+        for file in upload_files:
+            file["chunks"] = new_chunk_ids(file["size"], chunk_size)
 
         # need to check for for real changes in geodiff files using geodiff tool (comparing checksum is not enough)
         not_updated = []
@@ -445,7 +509,7 @@ class MerginProject:
                 if self.geodiff.has_changes(diff_file):
                     diff_size = os.path.getsize(diff_file)
                     file["checksum"] = file["origin_checksum"]  # need to match basefile on server
-                    file["chunks"] = [str(uuid.uuid4()) for i in range(math.ceil(diff_size / UPLOAD_CHUNK_SIZE))]
+                    file["chunks"] = new_chunk_ids(diff_size, chunk_size)
                     file["mtime"] = datetime.fromtimestamp(os.path.getmtime(current_file), tzlocal())
                     file["diff"] = {
                         "path": diff_name,
@@ -466,7 +530,7 @@ class MerginProject:
         changes["updated"] = [f for f in changes["updated"] if f not in not_updated]
         return changes
 
-    def copy_versioned_file_for_upload(self, f, tmp_dir):
+    def copy_versioned_file_for_upload(self, f, tmp_dir, chunk_size=UPLOAD_CHUNK_SIZE):
         """
         Make a temporary copy of the versioned file using geodiff, to make sure that we have full
         content in a single file (nothing left in WAL journal)
@@ -478,7 +542,7 @@ class MerginProject:
         self.geodiff.make_copy_sqlite(self.fpath(path), tmp_file)
         f["size"] = os.path.getsize(tmp_file)
         f["checksum"] = generate_checksum(tmp_file)
-        f["chunks"] = [str(uuid.uuid4()) for i in range(math.ceil(f["size"] / UPLOAD_CHUNK_SIZE))]
+        f["chunks"] = new_chunk_ids(f["size"], chunk_size)
         f["upload_file"] = tmp_file
         return tmp_file
 
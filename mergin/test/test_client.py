@@ -4,11 +4,18 @@ import os
 import tempfile
 import subprocess
 import shutil
+import time
 from datetime import datetime, timedelta, date
 import pytest
 import pytz
 import sqlite3
 import glob
+import http.client
+import http.server
+import threading
+import urllib.request
+import concurrent.futures
+from types import SimpleNamespace
 
 from .. import InvalidProject
 from ..client import (
@@ -20,8 +27,20 @@ from ..client import (
     TokenError,
     ServerType,
     ErrorCode,
+    KeepAliveHTTPSHandler,
 )
-from ..client_push import push_project_async, push_project_cancel
+from ..client_push import (
+    UploadJob,
+    push_project_async,
+    push_project_cancel,
+    push_project_finalize,
+    push_project_is_running,
+    push_project_wait,
+    _do_upload,
+    _update_chunk_size,
+    _UPLOAD_POOL,
+)
+from ..common import MIN_UPLOAD_CHUNK_SIZE, UPLOAD_CHUNK_SIZE
 from ..client_pull import (
     download_project_async,
     download_project_wait,
@@ -406,6 +425,141 @@ def test_cancel_push(mc):
         assert f.read() == modification
 
 
+def test_push_small_chunks(mc):
+    """Test push of a file split into chunks smaller than the default size, with the last chunk not full"""
+    test_project = "test_push_small_chunks"
+    project = API_USER + "/" + test_project
+    project_dir = os.path.join(TMP_DIR, test_project)
+    project_dir_2 = os.path.join(TMP_DIR, test_project + "_2")
+    cleanup(mc, project, [project_dir, project_dir_2])
+    shutil.copytree(TEST_DATA_DIR, project_dir)
+    mc.create_project_and_push(project, project_dir)
+
+    f_added = "big.bin"
+    file_size = 3 * MIN_UPLOAD_CHUNK_SIZE + 12345
+    with open(os.path.join(project_dir, f_added), "wb") as f:
+        f.write(os.urandom(file_size))
+
+    mc.upload_chunk_size = MIN_UPLOAD_CHUNK_SIZE
+    job = push_project_async(mc, project_dir)
+    chunk_sizes = [item.size for item in job.upload_queue_items if item.file_path.endswith(f_added)]
+    assert chunk_sizes == [MIN_UPLOAD_CHUNK_SIZE] * 3 + [12345]
+    push_project_wait(job)
+    push_project_finalize(job)
+
+    mc.download_project(project, project_dir_2)
+    assert MerginProject(project_dir_2).version() == "v2"
+    assert generate_checksum(os.path.join(project_dir_2, f_added)) == generate_checksum(
+        os.path.join(project_dir, f_added)
+    )
+
+
+def test_push_wait_fail_fast(mc):
+    """Test that push_project_wait() stops the upload after the first failed chunk"""
+    test_project = "test_push_wait_fail_fast"
+    project = API_USER + "/" + test_project
+    project_dir = os.path.join(TMP_DIR, test_project)
+    cleanup(mc, project, [project_dir])
+    shutil.copytree(TEST_DATA_DIR, project_dir)
+    mc.create_project_and_push(project, project_dir)
+
+    f_added = os.path.join(project_dir, "big.bin")
+    with open(f_added, "wb") as f:
+        f.write(os.urandom(40 * MIN_UPLOAD_CHUNK_SIZE))
+
+    mc.upload_chunk_size = MIN_UPLOAD_CHUNK_SIZE
+    job = push_project_async(mc, project_dir)
+    # truncate the file, so that chunks which have not been read yet fail
+    open(f_added, "wb").close()
+    with pytest.raises(ClientError, match="has changed during upload"):
+        push_project_wait(job)
+    assert all(f.done() for f in job.futures)
+    assert any(f.cancelled() for f in job.futures)
+    push_project_cancel(job)
+
+    # cancelled futures (e.g. by push_project_cancel() from another thread) are just skipped
+    future = concurrent.futures.Future()
+    future.cancel()
+    future.set_running_or_notify_cancel()  # done by the executor for cancelled futures
+    push_project_wait(SimpleNamespace(futures=[future]))
+
+    # the aborted transaction does not block further pushes
+    mc.push_project(project_dir)
+    assert MerginProject(project_dir).version() == "v2"
+
+
+class _StubUploadItem:
+    """Upload queue item that only takes some time to upload (and optionally fails)"""
+
+    size = 1
+    shared_file = None
+
+    def __init__(self, upload_time, error=None):
+        self.upload_time = upload_time
+        self.error = error
+
+    def upload_blocking(self, mc, mp):
+        time.sleep(self.upload_time)
+        if self.error:
+            raise self.error
+
+
+def _start_stub_upload_job(items):
+    mc = SimpleNamespace(post=lambda *args: SimpleNamespace(msg="cancelled"))
+    mp = SimpleNamespace(log=logging.getLogger("test_push_pending_items"))
+    job = UploadJob("test/project", {}, "transaction", mp, mc, None)
+    job.executor = _UPLOAD_POOL
+    job.pending_items = len(items)
+    job.futures = [job.executor.submit(_do_upload, item, job) for item in items]
+    return job
+
+
+def test_push_pending_items():
+    """Test that push is not reported as running once all upload tasks are done or cancelled"""
+    job = _start_stub_upload_job([_StubUploadItem(0.01) for _ in range(10)])
+    assert push_project_is_running(job) is True
+    push_project_wait(job)
+    assert push_project_is_running(job) is False
+
+    # cancelled tasks never run, they are not pending anymore either
+    job = _start_stub_upload_job([_StubUploadItem(0.05) for _ in range(40)])
+    time.sleep(0.1)
+    push_project_cancel(job)
+    assert any(f.cancelled() for f in job.futures)
+    assert job.pending_items == 0
+    assert push_project_is_running(job) is False
+
+    # tasks cancelled after the first error are not counted twice when the job gets cancelled then
+    items = [_StubUploadItem(0.05, ClientError("upload failed"))] + [_StubUploadItem(0.05) for _ in range(40)]
+    job = _start_stub_upload_job(items)
+    with pytest.raises(ClientError, match="upload failed"):
+        push_project_wait(job)
+    assert job.pending_items == 0
+    push_project_cancel(job)
+    assert job.pending_items == 0
+
+
+def test_update_chunk_size():
+    """Test that chunk size for the next push is halved / doubled based on upload times of chunks"""
+
+    def next_chunk_size(chunk_size, upload_times):
+        mc = SimpleNamespace(upload_chunk_size=chunk_size)
+        mp = SimpleNamespace(log=logging.getLogger("test_update_chunk_size"))
+        job = SimpleNamespace(mc=mc, mp=mp, chunk_size=chunk_size, chunk_upload_times=upload_times)
+        _update_chunk_size(job)
+        return mc.upload_chunk_size
+
+    mib = 1024 * 1024
+    assert next_chunk_size(4 * mib, [11, 13]) == 2 * mib
+    assert next_chunk_size(4 * mib, [1, 2]) == 8 * mib
+    assert next_chunk_size(4 * mib, [5, 6]) == 4 * mib
+    assert next_chunk_size(4 * mib, []) == 4 * mib
+    # limits
+    assert next_chunk_size(MIN_UPLOAD_CHUNK_SIZE, [20]) == MIN_UPLOAD_CHUNK_SIZE
+    assert next_chunk_size(8 * mib, [1]) == UPLOAD_CHUNK_SIZE
+    assert next_chunk_size(UPLOAD_CHUNK_SIZE, [1]) == UPLOAD_CHUNK_SIZE
+
+
 def test_ignore_files(mc):
     test_project = "test_blacklist"
     project = API_USER + "/" + test_project
@@ -1776,6 +1930,148 @@ def test_unique_path_names():
         assert file_name == os.path.join(project_dir, i[1])
 
 
+def test_checksum_cache():
+    """
+    Test that checksums of unmodified files are taken from cache and modified files are hashed again.
+    """
+    project_dir = os.path.join(TMP_DIR, "checksum_cache")
+    remove_folders([project_dir])
+    shutil.copytree(TEST_DATA_DIR, project_dir)
+    MerginProject.write_metadata(project_dir, {"name": "checksum_cache", "namespace": API_USER, "files": []})
+
+    # make files old enough to get cached
+    old_time = datetime.now().timestamp() - 60
+    f_updated = os.path.join(project_dir, "test.txt")
+    for f in glob.glob(os.path.join(project_dir, "**", "*.*"), recursive=True):
+        os.utime(f, (old_time, old_time))
+
+    mp = MerginProject(project_dir)
+    files_meta = mp.inspect_files()
+    assert os.path.exists(mp.fpath_cache("checksum_cache.json"))
+    assert os.listdir(mp.cache_dir) == ["checksum_cache.json"]  # no temporary files left behind
+    assert MerginProject(project_dir).inspect_files() == files_meta
+
+    # file with unchanged size and modification time is not read again - its checksum comes from the cache
+    f_cached = os.path.join(project_dir, "test3.txt")
+    mtime_ns = os.stat(f_cached).st_mtime_ns
+    with open(f_cached, "r+b") as f:
+        content = f.read()
+        f.seek(0)
+        f.write(bytes(reversed(content)))
+    os.utime(f_cached, ns=(mtime_ns, mtime_ns))
+    checksum = next(f["checksum"] for f in MerginProject(project_dir).inspect_files() if f["path"] == "test3.txt")
+    assert checksum == next(f["checksum"] for f in files_meta if f["path"] == "test3.txt")
+    assert checksum != generate_checksum(f_cached)
+
+    # modify content of the file but keep its size
+    with open(f_updated, "r+b") as f:
+        content = f.read()
+        f.seek(0)
+        f.write(bytes(reversed(content)))
+    os.utime(f_updated, (old_time + 1, old_time + 1))
+
+    checksum = next(f["checksum"] for f in MerginProject(project_dir).inspect_files() if f["path"] == "test.txt")
+    assert checksum == generate_checksum(f_updated)
+    assert checksum != next(f["checksum"] for f in files_meta if f["path"] == "test.txt")
+
+
+class _KeepAliveHTTPHandler(KeepAliveHTTPSHandler):
+    """Plain HTTP variant of the handler, so that it can be tested against a local server without certificates"""
+
+    def http_open(self, req):
+        return self.do_open(http.client.HTTPConnection, req)
+
+
+class _KeepAliveServerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == "/drop" and self.server.drop_next:
+            # close the connection without any response
+            self.server.drop_next = False
+            self.close_connection = True
+            return
+        self._respond(b"x" * 1000000 if self.path == "/big" else b"ok")
+        if self.path == "/close":
+            self.close_connection = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(self.path)
+        if self.path == "/finish":
+            # request gets processed, but the connection is closed before the response is sent
+            self.close_connection = True
+            return
+        self._respond(b"ok")
+
+
+def test_keep_alive_connections():
+    """
+    Test that connections are reused, replaced when they can't be used anymore and that requests
+    which might have been processed by the server are not sent again.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveServerHandler)
+    server.connections = 0
+    server.requests = []
+    server.drop_next = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+    handler = _KeepAliveHTTPHandler()
+    opener = urllib.request.OpenerDirector()
+    opener.add_handler(handler)
+    try:
+        # connection is reused
+        assert opener.open(url + "/a").read() == b"ok"
+        assert opener.open(url + "/b").read() == b"ok"
+        assert server.connections == 1
+
+        # response that has not been read completely forces a new connection
+        opener.open(url + "/big")
+        assert opener.open(url + "/c").read() == b"ok"
+        assert server.connections == 2
+
+        # connection closed by the server while idle is replaced
+        assert opener.open(url + "/close").read() == b"ok"
+        assert opener.open(url + "/d").read() == b"ok"
+        assert server.connections == 3
+
+        # idempotent request gets sent again when the reused connection is dropped without response
+        server.drop_next = True
+        assert opener.open(url + "/drop").read() == b"ok"
+        assert server.connections == 4
+        assert server.requests[-2:] == ["/drop", "/drop"]
+
+        # connection idle for too long is not reused
+        handler.max_idle_time = 0
+        assert opener.open(url + "/e").read() == b"ok"
+        assert server.connections == 5
+        handler.max_idle_time = KeepAliveHTTPSHandler.max_idle_time
+
+        # POST which may have been processed by the server is not sent again
+        server.requests.clear()
+        assert opener.open(url + "/start", b"data").read() == b"ok"
+        with pytest.raises((OSError, http.client.HTTPException)):
+            opener.open(url + "/finish", b"data")
+        assert server.requests == ["/start", "/finish"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 def create_directory(root, data):
     for k, v in data.items():
         if isinstance(v, dict):
@@ -1,15 +1,15 @@
 import os
-import io
 import json
 import hashlib
 import re
+import shutil
 import sqlite3
 from datetime import datetime
 from pathlib import Path
 from .common import ClientError
 
 
-def generate_checksum(file, chunk_size=4096):
+def generate_checksum(file, chunk_size=1024 * 1024):
     """
     Generate checksum for file from chunks.
 
@@ -18,12 +18,15 @@ def generate_checksum(file, chunk_size=4096):
     :return: sha1 checksum
     """
     checksum = hashlib.sha1()
-    with open(file, "rb") as f:
+    with open(file, "rb", buffering=0) as f:
+        # small files do not need the whole (zero-filled) buffer
+        buffer = bytearray(min(chunk_size, max(os.fstat(f.fileno()).st_size, 1)))
+        view = memoryview(buffer)
         while True:
-            chunk = f.read(chunk_size)
-            if not chunk:
+            size = f.readinto(buffer)
+            if not size:
                 return checksum.hexdigest()
-            checksum.update(chunk)
+            checksum.update(view[:size])
 
 
 def save_to_file(stream, path):
@@ -37,14 +40,7 @@ def save_to_file(stream, path):
     os.makedirs(directory, exist_ok=True)
 
     with open(path, "wb") as output:
-        writer = io.BufferedWriter(output, buffer_size=32768)
-        while True:
-            part = stream.read(4096)
-            if part:
-                writer.write(part)
-            else:
-                writer.flush()
-                break
+        shutil.copyfileobj(stream, output, length=1024 * 1024)
 
 
 def move_file(src, dest):